@@ -1,5 +1,6 @@
 from openai_chatbot import OpenAIChatbot
 import os
+import sys
 from pathlib import Path
 
 # Clash for Windows 的端口是7890
@@ -8,6 +9,8 @@ os.environ["http_proxy"] = "http://127.0.0.1:7890"
 os.environ["https_proxy"] = "http://127.0.0.1:7890"
 
 if __name__ == "__main__":
+    # 流式输出自己控制flush节奏，关掉stdout的行缓冲
+    sys.stdout.reconfigure(line_buffering=False, write_through=False)
     chatbot = OpenAIChatbot(
             model_name="gemini-2.0-flash-lite-preview-02-05",
             history_file=Path("chat_history.json"),
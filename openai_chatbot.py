@@ -1,34 +1,391 @@
 import os
+import sys
+import time
+import mmap
+import atexit
+import socket
+import hashlib
+import asyncio
+import inspect
+import functools
+import threading
 
 from pathlib import Path
 from typing import Optional, Dict
+from urllib.parse import urlparse
 import json
-from openai import OpenAI, Stream
+
+try:
+    import msgspec.json
+    _msgspec_decode = msgspec.json.decode
+    _msgspec_encode = msgspec.json.encode
+except ImportError:
+    _msgspec_decode = _msgspec_encode = None
+
+try:
+    import orjson
+except ImportError:  # orjson是可选依赖，没装就退回stdlib json
+    orjson = None
+
+try:
+    import zstandard as zstd
+except ImportError:
+    zstd = None
+
+import httpx
+from openai import OpenAI, AsyncOpenAI, Stream
 from openai.types.chat import ChatCompletionChunk, ChatCompletion
 
 
 def handle_openai_errors(func):
-    """Decorator to handle OpenAI API errors."""
+    """Decorator to handle OpenAI API errors. Works for sync and async functions."""
+    if inspect.iscoroutinefunction(func):
+        async def awrapper(*args, **kwargs):
+            try:
+                return await func(*args, **kwargs)
+            except ValueError:
+                raise  # 输入校验错误原样抛出，不要伪装成网络错误
+            except Exception as e:
+                raise ConnectionError(f"Error communicating with OpenAI: {str(e)}")
+        return awrapper
+
     def wrapper(*args, **kwargs):
         try:
             return func(*args, **kwargs)
+        except ValueError:
+            raise
         except Exception as e:
             raise ConnectionError(f"Error communicating with OpenAI: {str(e)}")
     return wrapper
 
+
+class ResponseCache:
+    """Exact-match response cache: one JSON file per (model, messages, temperature) key.
+
+    命中缓存时直接返回之前的回复，省掉一次完整的网络往返。
+    只适合完全重复的请求（比如 agent 循环、批量翻译里重复的 prompt）。
+    """
+
+    def __init__(self, cache_dir: Path, ttl: float = 3600.0) -> None:
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(model_name: str, messages: list, temperature: float) -> str:
+        payload = json.dumps(
+            {"model": model_name, "messages": messages, "temperature": temperature},
+            sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        path = self.cache_dir / f"{key}.json"
+        if not path.exists():
+            return None
+        try:
+            entry = json.loads(path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError):
+            return None
+        if time.time() - entry["timestamp"] > self.ttl:
+            return None
+        return entry["response_text"]
+
+    def put(self, key: str, response_text: str) -> None:
+        path = self.cache_dir / f"{key}.json"
+        path.write_text(
+            json.dumps({"timestamp": time.time(), "response_text": response_text},
+                       ensure_ascii=False),
+            encoding="utf-8")
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_client(api_key: Optional[str], base_url: Optional[str]) -> OpenAI:
+    """Per-(api_key, base_url) cached OpenAI client.
+
+    OpenAI()构造要建SSL上下文、header字典和httpx连接池，同进程里
+    起多个chatbot（或测试里反复实例化）时这笔钱只付一次。
+    需要全新client时调_cached_client.cache_clear()。
+    """
+    return OpenAI(api_key=api_key, base_url=base_url,
+                  http_client=_build_http_client())
+
+
+@functools.lru_cache(maxsize=8)
+def _cached_aclient(api_key: Optional[str], base_url: Optional[str]) -> AsyncOpenAI:
+    """Async twin of _cached_client."""
+    return AsyncOpenAI(api_key=api_key, base_url=base_url,
+                       http_client=_build_async_http_client())
+
+
+def _build_http_client() -> httpx.Client:
+    """Shared httpx client: aggressive keepalive so non-first turns skip TCP+TLS setup."""
+    limits = httpx.Limits(max_keepalive_connections=8, keepalive_expiry=300.0)
+    timeout = httpx.Timeout(60.0, connect=5.0)
+    try:
+        return httpx.Client(http2=True, limits=limits, timeout=timeout)
+    except ImportError:
+        # HTTP/2需要httpx[http2]（h2包）；没装就退回HTTP/1.1，连接复用仍然生效
+        return httpx.Client(limits=limits, timeout=timeout)
+
+
+def _build_async_http_client() -> httpx.AsyncClient:
+    """Async twin of _build_http_client, same pooling/timeout settings."""
+    limits = httpx.Limits(max_keepalive_connections=8, keepalive_expiry=300.0)
+    timeout = httpx.Timeout(60.0, connect=5.0)
+    try:
+        return httpx.AsyncClient(http2=True, limits=limits, timeout=timeout)
+    except ImportError:
+        return httpx.AsyncClient(limits=limits, timeout=timeout)
+
+
+class _StreamPrinter:
+    """Batch stdout writes while streaming.
+
+    每个SSE delta都print+flush一次等于每个token一次write(2)系统调用。
+    这里先攒着，满64个字符或距上次输出超过16ms才真正写terminal。
+    """
+
+    def __init__(self, min_chars: int = 64, max_delay: float = 0.016) -> None:
+        self._buf = []
+        self._buffered = 0
+        self._min_chars = min_chars
+        self._max_delay = max_delay
+        self._last_flush = time.monotonic()
+
+    def write(self, content: str) -> None:
+        self._buf.append(content)
+        self._buffered += len(content)
+        if (self._buffered >= self._min_chars
+                or time.monotonic() - self._last_flush > self._max_delay):
+            self.flush()
+
+    def flush(self) -> None:
+        if self._buf:
+            sys.stdout.write("".join(self._buf))
+            self._buf.clear()
+            self._buffered = 0
+        sys.stdout.flush()
+        self._last_flush = time.monotonic()
+
+
+def _close_history_fp(fp, lock: threading.Lock) -> None:
+    """Flush, fsync and close the history handle; safe to call more than once."""
+    with lock:
+        if fp.closed:
+            return
+        fp.flush()
+        os.fsync(fp.fileno())
+        fp.close()
+
+
+def _warm_dns(base_url: Optional[str]) -> None:
+    """Pre-resolve the API hostname so the first turn doesn't wait on DNS."""
+    host, port = "api.openai.com", 443
+    if base_url:
+        parsed = urlparse(base_url)
+        host = parsed.hostname or host
+        port = parsed.port or 443
+    try:
+        socket.getaddrinfo(host, port)
+    except OSError:
+        pass  # 解析失败就留给第一次请求自己报错
+
+
+def _noop_token(_content: str) -> None:
+    """Default token sink: a plain no-op call, the cheapest thing per chunk."""
+
+
+def _periodic_flush(fp, lock: threading.Lock, stop: threading.Event,
+                    interval: float = 0.5) -> None:
+    """Background timer: flush the buffered history writer every `interval` seconds."""
+    while not stop.wait(interval):
+        with lock:
+            if fp.closed:
+                return
+            fp.flush()
+
+
+def _loads(data: bytes):
+    # msgspec的C解码器是目前最快的，其次orjson，最后stdlib json
+    if _msgspec_decode is not None:
+        return _msgspec_decode(data)
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _dumps_line(msg: Dict) -> bytes:
+    if _msgspec_encode is not None:
+        return _msgspec_encode(msg) + b"\n"
+    if orjson is not None:
+        return orjson.dumps(msg) + b"\n"
+    return (json.dumps(msg, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+class JsonFileHistoryStore:
+    """Append-only JSONL history storage (optionally zstd-compressed).
+
+    历史写入是带缓冲的：攒够flush_every条消息（或后台定时器每500ms）
+    才真正落盘一次。需要强持久化时append(..., sync=True)或close()。
+
+    文件名以.zst结尾时整个文件用zstd压缩存储（需要zstandard包），
+    文本历史一般能压5-10倍。压缩模式下追加攒在内存里，flush时整体
+    重写，所以长会话记得调close()保证落盘。
+    """
+
+    def __init__(self, history_file: Path, flush_every: int = 8) -> None:
+        if not history_file.exists():
+            raise FileNotFoundError(f"History file not found: {history_file}")
+        self.history_file = history_file
+        # str形式缓存一份：open()走str不用每次os.fspath(Path)
+        self._path_str = str(history_file)
+        self._compressed = history_file.suffix == ".zst"
+        if self._compressed and zstd is None:
+            raise ValueError("zstandard is required for .zst history files")
+        self._flush_every = flush_every
+        self._pending = 0
+        self._history: list = []
+        self._flush_lock = threading.Lock()
+        self._stop_flush = threading.Event()
+        self._history_fp = open(self._path_str, 'ab', buffering=64 * 1024)
+        # 定时flush线程只拿文件句柄，不拿self，免得引用环挡住__del__
+        threading.Thread(
+            target=_periodic_flush,
+            args=(self._history_fp, self._flush_lock, self._stop_flush),
+            daemon=True).start()
+        # atexit同样只注册句柄，进程退出时保证缓冲里的消息落盘
+        atexit.register(_close_history_fp, self._history_fp, self._flush_lock)
+
+    def load(self) -> list:
+        """Load chat history (JSONL, one message per line).
+
+        旧版本的历史文件是一个完整的JSON数组，第一次加载时会原地迁移成JSONL。
+        用mmap读：多个进程加载同一份历史时共享同一份page cache，
+        第一个进程之后的冷启动几乎不花时间在读文件上。
+        """
+        self._history = self._read()
+        return list(self._history)
+
+    def _read(self) -> list:
+        if self._compressed:
+            raw = self.history_file.read_bytes()
+            if not raw:
+                return []
+            data = zstd.ZstdDecompressor().decompress(raw)
+            return [_loads(line) for line in data.splitlines() if line.strip()]
+        with open(self._path_str, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return []
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            head = mm[:16].lstrip()[:1]
+            if head == b'':
+                return []
+            if head == b'[':
+                # legacy whole-file JSON array: parse once, rewrite as JSONL
+                legacy = _loads(mm[:])
+                mm.close()
+                self.history_file.write_bytes(
+                    b"".join(_dumps_line(m) for m in legacy))
+                return legacy
+            history = []
+            line = mm.readline()
+            while line:
+                if line.strip():
+                    history.append(_loads(line))
+                line = mm.readline()
+            return history
+        finally:
+            if not mm.closed:
+                mm.close()
+
+    def append(self, msg: Dict, sync: bool = False) -> None:
+        """Append one message.
+
+        每轮只写自己那一条，O(1)；不再整个文件重写（以前是O(N)）。
+        写入先进64KB缓冲，攒够flush_every条才flush，减少write(2)次数。
+        """
+        with self._flush_lock:
+            self._history.append(msg)
+            if self._compressed:
+                self._pending += 1
+                if sync or self._pending >= self._flush_every:
+                    self._write_compressed()
+                return
+            self._history_fp.write(_dumps_line(msg))
+            self._pending += 1
+            if sync:
+                self._history_fp.flush()
+                os.fsync(self._history_fp.fileno())
+                self._pending = 0
+            elif self._pending >= self._flush_every:
+                self._history_fp.flush()
+                self._pending = 0
+
+    def _write_compressed(self) -> None:
+        """Rewrite the whole history as one zstd frame (cost amortized by flush_every)."""
+        payload = b"".join(_dumps_line(m) for m in self._history)
+        self.history_file.write_bytes(zstd.ZstdCompressor(level=3).compress(payload))
+        self._pending = 0
+
+    def close(self) -> None:
+        """Flush and close the file handle. fsync once on graceful shutdown."""
+        self._stop_flush.set()
+        if self._compressed:
+            with self._flush_lock:
+                if self._pending:
+                    self._write_compressed()
+        _close_history_fp(self._history_fp, self._flush_lock)
+
+
 class OpenAIChatbot:
-    def __init__(self, model_name: str, history_file: Path, 
+    def __init__(self, model_name: str, history_file: Optional[Path] = None,
                 system_prompt: str = "You are a helpful assistant.",
                  api_key: Optional[str] = None,
                  base_url: Optional[str] = None,
-                 temperature: float = 0.7) -> None:
+                 temperature: float = 0.7,
+                 cache_dir: Optional[Path] = None,
+                 cache_ttl: float = 3600.0,
+                 flush_every: int = 8,
+                 max_turns: int = 20,
+                 max_context_tokens: Optional[int] = None,
+                 use_prompt_cache: bool = False,
+                 extra_body: Optional[Dict] = None,
+                 history_store=None) -> None:
         """
         如果history_file只有一个空数组，那么就会加载system_prompt。
         如果history_file有内容，那就不加载system_prompt。
+
+        传入cache_dir（例如 Path.home() / ".cache" / "llm-utils"）会开启
+        响应缓存：完全相同的请求在cache_ttl秒内直接返回上次的回复。
+
+        历史写入是带缓冲的：攒够flush_every条消息（或后台定时器每500ms）
+        才真正落盘一次。需要强持久化时用chat(..., sync=True)或close()。
+        压缩格式等细节见JsonFileHistoryStore。
+
+        每次请求只发送system prompt加最近max_turns轮对话，完整历史仍然
+        全部落盘。这样单轮的token开销不会随会话变长而线性增长。
+
+        history_store可以注入任何实现load()/append()/close()的对象来
+        替换默认的JSONL文件存储（比如测试用的纯内存store）。
+
+        use_prompt_cache=True时system prompt会带上cache_control标记，
+        支持服务端prompt caching的provider就能复用前缀的KV cache。
+        （标准OpenAI端点不认这个格式，所以默认关。）extra_body会原样
+        传给每次create调用，比如Gemini的{"cached_content": ...}。
         """
 
-        if not history_file.exists():
-            raise FileNotFoundError(f"History file not found: {history_file}")
+        if history_store is None:
+            if history_file is None:
+                raise ValueError("Either history_file or history_store must be provided")
+            history_store = JsonFileHistoryStore(history_file, flush_every=flush_every)
+        self._store = history_store
+
+        # base_url在init就校验一次，而不是每次请求都让SDK去猜
+        if base_url:
+            parsed = urlparse(base_url)
+            if parsed.scheme not in ("http", "https") or not parsed.hostname:
+                raise ValueError(f"Invalid base_url: {base_url}")
 
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         if self.api_key is None:
@@ -36,50 +393,176 @@ class OpenAIChatbot:
 
         self.temperature = temperature
         self.model_name = model_name
+        self.max_turns = max_turns
+        self.max_context_tokens = max_context_tokens
         self.history_file = history_file
         self.system_prompt = system_prompt
-        self.chat_history = []
-        self._load_history()
+        self._intern: Dict[str, str] = {}
+        self.chat_history = self._store.load()
+        # 长会话里很多内容会逐字重复（确认语、工具提示等），intern一下共享对象
+        for m in self.chat_history:
+            content = m.get("content")
+            if isinstance(content, str):
+                m["content"] = self._i(content)
         if not self.chat_history:
             self.chat_history = [{'role': 'system', 'content': system_prompt}]
-        self.client = OpenAI(api_key=self.api_key, 
-            base_url=base_url if base_url else None)
+            self._store.append(self.chat_history[0])
+        self.extra_body = extra_body
+        # system message只构造一次，之后每次请求发送的前缀都是同一个对象，
+        # 字节级一致，服务端的prompt cache才能命中
+        self._system_message = None
+        if (use_prompt_cache and self.chat_history
+                and self.chat_history[0].get("role") == "system"):
+            self._system_message = {
+                "role": "system",
+                "content": [{"type": "text",
+                             "text": self.chat_history[0]["content"],
+                             "cache_control": {"type": "ephemeral"}}],
+            }
+        self.cache = ResponseCache(cache_dir, ttl=cache_ttl) if cache_dir else None
+        # client按(api_key, base_url)缓存复用，连接池在实例间共享
+        self.client = _cached_client(self.api_key, base_url if base_url else None)
+        self.aclient = _cached_aclient(self.api_key, base_url if base_url else None)
+        self._history_alock = asyncio.Lock()
+        # 后台预热DNS，把首轮的解析延迟挪出用户可见路径
+        threading.Thread(target=_warm_dns, args=(base_url,), daemon=True).start()
+
+    def _i(self, s: str) -> str:
+        """Intern message content: identical strings share one Python object."""
+        if not isinstance(s, str):
+            return s
+        return self._intern.setdefault(s, sys.intern(s))
+
+    @property
+    def client(self) -> OpenAI:
+        return self._client
+
+    @client.setter
+    def client(self, value: OpenAI) -> None:
+        # create绑定一次，热路径上省掉client.chat.completions.create四级属性查找
+        self._client = value
+        self._create = value.chat.completions.create
+
+    @property
+    def aclient(self) -> AsyncOpenAI:
+        return self._aclient
+
+    @aclient.setter
+    def aclient(self, value: AsyncOpenAI) -> None:
+        self._aclient = value
+        self._acreate = value.chat.completions.create
+
+    def _windowed_messages(self) -> list:
+        """System prompt + the last max_turns turns; the stable prefix stays byte-identical
+        so provider-side prompt caching can still hit."""
+        if not self.chat_history:
+            return []
+        head = self._system_message or self.chat_history[0]
+        return [head] + self.chat_history[1:][-2 * self.max_turns:]
+
+    @staticmethod
+    def _estimate_tokens(messages: list) -> int:
+        """Rough estimate: ~4 chars per token. 只用来做上限检查，不求精确。"""
+        return sum(len(m.get("content") or "") for m in messages) // 4
+
+    def _precheck(self, message: str) -> bool:
+        """Pre-filter: short-circuit trivial or oversized prompts before the network call.
+
+        返回False表示直接跳过这次请求（空消息）；超长则抛ValueError。
+        """
+        if not message or not message.strip():
+            print("[llm-utils] skip empty message", file=sys.stderr)
+            return False
+        if self.max_context_tokens is not None:
+            estimated = self._estimate_tokens(self._windowed_messages()) + len(message) // 4
+            if estimated > self.max_context_tokens:
+                raise ValueError(
+                    f"Estimated prompt tokens ({estimated}) exceed "
+                    f"max_context_tokens ({self.max_context_tokens})")
+        return True
+
+    def _cache_lookup(self) -> tuple:
+        """Return (key, cached_text); both are None when caching is off."""
+        if self.cache is None:
+            return None, None
+        key = ResponseCache.make_key(self.model_name, self._windowed_messages(), self.temperature)
+        cached = self.cache.get(key)
+        print(f"[llm-utils] cache {'hit' if cached is not None else 'miss'} {key[:12]}",
+              file=sys.stderr)
+        return key, cached
 
     @handle_openai_errors
-    def chat_stream(self, message: str, should_print: bool = True) -> str:
+    def chat_stream(self, message: str, should_print: bool = True, sync: bool = False,
+                    on_token=None) -> str:
         """
+        on_token是每个流式片段的回调（比如WebSocket推送、TUI渲染），传了它
+        就不再往terminal打印。不传且should_print=True时走默认的批量打印。
+
         !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         debug时如果开启了print，当你把terminal内容发送给cursor后，
         可能会让它对bug源头产生误解（cursor可能没注意到这个函数开启了print）
         !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
         """
-        self.chat_history.append({"role": "user", "content": message})
-        
-        stream = self.client.chat.completions.create(
+        if not self._precheck(message):
+            return ""
+
+        user_msg = {"role": "user", "content": self._i(message)}
+        self.chat_history.append(user_msg)
+        self._store.append(user_msg)
+
+        printer = _StreamPrinter() if on_token is None and should_print else None
+        # 循环外算好每个chunk要调用的回调，循环里只剩一次call
+        emit = on_token if on_token is not None else (
+            printer.write if printer is not None else _noop_token)
+
+        cache_key, cached = self._cache_lookup()
+        if cached is not None:
+            # 按小段重放缓存的回复，保持流式输出的观感
+            for i in range(0, len(cached), 16):
+                emit(cached[i:i + 16])
+            if printer is not None:
+                printer.write("\n")
+                printer.flush()
+            assistant_msg = {"role": "assistant", "content": self._i(cached)}
+            self.chat_history.append(assistant_msg)
+            self._store.append(assistant_msg, sync=sync)
+            return cached
+
+        stream = self._create(
             model=self.model_name,
-            messages=self.chat_history,
+            messages=self._windowed_messages(),
             temperature=self.temperature,
-            stream=True
+            stream=True,
+            extra_body=self.extra_body
         )
         
-        full_response = ""
+        # +=拼接字符串是O(总长度²)，攒进list最后join一次是O(总长度)
+        parts = []
+        append = parts.append
         for chunk in stream:
-            if chunk.choices[0].delta.content:
-                content = chunk.choices[0].delta.content
-                full_response += content
-                if should_print:
-                    print(content, end="", flush=True)
-        
-        if should_print:
-            print()
-            
-        self.chat_history.append({"role": "assistant", "content": full_response})
-        self._save_history()
-        
+            # 属性链提前取成局部变量，少走几条LOAD_ATTR
+            content = chunk.choices[0].delta.content
+            if content:
+                append(content)
+                emit(content)
+
+        if printer is not None:
+            printer.write("\n")
+            printer.flush()
+
+        full_response = "".join(parts)
+
+        if cache_key is not None:
+            self.cache.put(cache_key, full_response)
+
+        assistant_msg = {"role": "assistant", "content": self._i(full_response)}
+        self.chat_history.append(assistant_msg)
+        self._store.append(assistant_msg, sync=sync)
+
         return full_response
 
     @handle_openai_errors
-    def chat(self, message: str, should_print: bool = True) -> str:
+    def chat(self, message: str, should_print: bool = True, sync: bool = False) -> str:
         """Without streaming. 
 
         !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
@@ -88,33 +571,94 @@ class OpenAIChatbot:
         !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
 
         """
-        self.chat_history.append({"role": "user", "content": message})
-        
-        response = self.client.chat.completions.create(
+        if not self._precheck(message):
+            return ""
+
+        user_msg = {"role": "user", "content": self._i(message)}
+        self.chat_history.append(user_msg)
+        self._store.append(user_msg)
+
+        cache_key, cached = self._cache_lookup()
+        if cached is not None:
+            if should_print:
+                print(cached)
+            assistant_msg = {"role": "assistant", "content": self._i(cached)}
+            self.chat_history.append(assistant_msg)
+            self._store.append(assistant_msg, sync=sync)
+            return cached
+
+        response = self._create(
             model=self.model_name,
-            messages=self.chat_history,
+            messages=self._windowed_messages(),
             temperature=self.temperature,
-            stream=False
+            stream=False,
+            extra_body=self.extra_body
         )
         
         response_text = response.choices[0].message.content or ""
-        
+
+        # tool_calls的回复不是纯文本，不能缓存
+        if cache_key is not None and not getattr(response.choices[0].message, "tool_calls", None):
+            self.cache.put(cache_key, response_text)
+
         if should_print:
             print(response_text)
-            
-        self.chat_history.append({"role": "assistant", "content": response_text})
-        self._save_history()
-        
+
+        assistant_msg = {"role": "assistant", "content": self._i(response_text)}
+        self.chat_history.append(assistant_msg)
+        self._store.append(assistant_msg, sync=sync)
+
         return response_text
 
-    def _load_history(self) -> None:
-        """Load chat history from JSON file.
+    @handle_openai_errors
+    async def achat(self, message: str, should_print: bool = True) -> str:
+        """Async version of chat, for running many prompts concurrently.
+
+        历史追加用asyncio.Lock串行化，避免并发请求交错写入。
         """
-        with open(self.history_file, 'r', encoding='utf-8') as f:
-            self.chat_history = json.load(f)
-    
-
-    def _save_history(self) -> None:
-        """Save chat history to JSON file."""
-        with open(self.history_file, 'w', encoding='utf-8') as f:
-            json.dump(self.chat_history, f, ensure_ascii=False, indent=2)
+        if not self._precheck(message):
+            return ""
+
+        async with self._history_alock:
+            user_msg = {"role": "user", "content": self._i(message)}
+            self.chat_history.append(user_msg)
+            self._store.append(user_msg)
+            messages = self._windowed_messages()
+
+        response = await self._acreate(
+            model=self.model_name,
+            messages=messages,
+            temperature=self.temperature,
+            stream=False,
+            extra_body=self.extra_body
+        )
+
+        response_text = response.choices[0].message.content or ""
+
+        if should_print:
+            print(response_text)
+
+        async with self._history_alock:
+            assistant_msg = {"role": "assistant", "content": self._i(response_text)}
+            self.chat_history.append(assistant_msg)
+            self._store.append(assistant_msg)
+
+        return response_text
+
+    async def achat_many(self, messages: list) -> list:
+        """Send many independent prompts concurrently; wall time ~max(latency) instead of sum."""
+        return list(await asyncio.gather(*[self.achat(m, should_print=False) for m in messages]))
+
+    def close(self) -> None:
+        """Flush/close the history store.
+
+        HTTP client是跨实例共享的缓存对象，不在这里关；
+        要强制重建连接池用_cached_client.cache_clear()。
+        """
+        self._store.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
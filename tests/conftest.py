@@ -0,0 +1,122 @@
+import os
+import shutil
+import json
+import builtins
+
+# 测试的tmp文件都是一次性的，别为它们stat/写__pycache__
+os.environ.setdefault("PYTHONDONTWRITEBYTECODE", "1")
+
+import pytest
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_INITIAL_HISTORY = [
+    {"role": "system", "content": "You are a helpful assistant."}
+]
+# 模板文件的JSON payload只编码一次，整个session复用这份bytes
+_INITIAL_BYTES = (orjson.dumps(_INITIAL_HISTORY) if orjson is not None
+                  else json.dumps(_INITIAL_HISTORY, ensure_ascii=False).encode("utf-8"))
+
+
+def dump_json(path, obj) -> None:
+    """测试夹具写JSON用orjson直接出bytes，跳过文本编码；没装就退回stdlib。"""
+    if orjson is not None:
+        path.write_bytes(orjson.dumps(obj))
+    else:
+        path.write_text(json.dumps(obj, ensure_ascii=False), encoding='utf-8')
+
+
+class StubChat:
+    """手写的假client，顶替openai.OpenAI。
+
+    MagicMock每个实例约2KB，属性访问走Python级__getattr__代理；
+    这个stub就是普通的绑定方法调用。self.chat/self.completions都指回
+    自己，所以chatbot.client.chat.completions.create照样能走通。
+    用法：chatbot.client.next = 响应（或异常实例）；发出的kwargs记录在calls里。
+    """
+
+    def __init__(self):
+        self.chat = self
+        self.completions = self
+        self.next = None
+        self.calls = []
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        if isinstance(self.next, BaseException):
+            raise self.next
+        if type(self.next) is tuple:
+            # 流式响应是裸tuple（namedtuple响应不算）：chunk元组在
+            # 模块级复用，每次调用给一个新迭代器
+            return iter(self.next)
+        return self.next
+
+
+@pytest.fixture(autouse=True, scope="session")
+def _silence_print():
+    """整个session把print换成no-op：测试不用逐个传should_print=False，
+    丢弃的输出连参数格式化都省了"""
+    orig = builtins.print
+    builtins.print = lambda *a, **k: None
+    yield
+    builtins.print = orig
+
+
+class MemoryStore:
+    """纯内存的history store，单元测试不用碰磁盘。
+
+    实现和JsonFileHistoryStore一样的load()/append()/close()协议，
+    持久化契约本身由少数几个真正读写文件的集成测试覆盖。
+    """
+
+    def __init__(self, initial=()):
+        self.data = list(initial)
+
+    def load(self):
+        return list(self.data)
+
+    def append(self, msg, sync=False):
+        self.data.append(msg)
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(scope="session")
+def _history_template(tmp_path_factory):
+    """初始历史只序列化一次（session scope），每个测试copy2一份自己的副本"""
+    template = tmp_path_factory.mktemp("tmpl") / "history_template.json"
+    template.write_bytes(_INITIAL_BYTES)
+    return template
+
+
+@pytest.fixture
+def mock_history_file(tmp_path, _history_template):
+    """创建一个临时的历史文件用于测试"""
+    history_file = tmp_path / "test_history.json"
+    shutil.copy2(_history_template, history_file)
+    return history_file
+
+
+@pytest.fixture(scope="session")
+def chatbot_cls():
+    """懒加载OpenAIChatbot：import openai会连带拉起httpx/pydantic，
+    几百ms的import开销推迟到第一个真正用到它的测试"""
+    from openai_chatbot import OpenAIChatbot
+    return OpenAIChatbot
+
+
+@pytest.fixture
+def chatbot(chatbot_cls):
+    """创建一个测试用的chatbot实例：内存store + StubChat，全程零磁盘IO"""
+    bot = chatbot_cls(
+        model_name="gpt-3.5-turbo",
+        api_key="test_key",
+        history_store=MemoryStore(_INITIAL_HISTORY)
+    )
+    # client的setter会把_create重新绑定到stub.create上
+    bot.client = StubChat()
+    return bot
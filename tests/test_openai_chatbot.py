@@ -1,178 +1,277 @@
-import unittest
-import tempfile
+import asyncio
 import shutil
+from collections import namedtuple
 from pathlib import Path
-import json
-from unittest.mock import Mock, patch
-from openai_chatbot import OpenAIChatbot
+from types import MappingProxyType
+from unittest.mock import AsyncMock
+from conftest import StubChat, dump_json
 import pytest
-import os
-
-@pytest.fixture
-def mock_history_file(tmp_path):
-    """创建一个临时的历史文件用于测试"""
-    history_file = tmp_path / "test_history.json"
-    initial_history = [
-        {"role": "system", "content": "You are a helpful assistant."}
-    ]
-    with open(history_file, 'w', encoding='utf-8') as f:
-        json.dump(initial_history, f)
-    return history_file
-
-@pytest.fixture
-def chatbot(mock_history_file):
-    """创建一个测试用的chatbot实例"""
-    return OpenAIChatbot(
-        model_name="gpt-3.5-turbo",
-        history_file=mock_history_file,
-        api_key="test_key"
-    )
 
-class TestOpenAIChatbot(unittest.TestCase):
-    """OpenAIChatbot的测试类"""
-    
-    def setUp(self):
-        """测试前的设置"""
-        # 创建临时目录和文件
-        self.temp_dir = tempfile.mkdtemp()
-        self.history_file = Path(self.temp_dir) / "test_history.json"
-        initial_history = [
-            {"role": "system", "content": "You are a helpful assistant."}
-        ]
-        with open(self.history_file, 'w', encoding='utf-8') as f:
-            json.dump(initial_history, f)
-            
-        self.chatbot = OpenAIChatbot(
-            model_name="gpt-3.5-turbo",
-            history_file=self.history_file,
-            api_key="test_key"
-        )
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-    def tearDown(self):
-        """测试后的清理"""
-        shutil.rmtree(self.temp_dir)
-
-    def test_init_missing_history_file(self):
-        """测试历史文件不存在时的错误处理"""
-        with self.assertRaises(FileNotFoundError):
-            OpenAIChatbot(
-                model_name="gpt-3.5-turbo",
-                history_file=Path("nonexistent.json"),
-                api_key="test_key"
-            )
-
-    def test_chat(self):
-        """测试普通聊天功能"""
-        mock_response = Mock()
-        mock_response.choices = [
-            Mock(message=Mock(content="This is a test response"))
-        ]
-        
-        # 替换 chatbot.client.chat.completions.create 方法
-        with patch.object(self.chatbot.client.chat.completions, 'create', return_value=mock_response):
-            response = self.chatbot.chat("Test message", should_print=False)
-            
-            self.assertEqual(response, "This is a test response")
-            # 验证历史记录是否正确更新
-            self.assertEqual(len(self.chatbot.chat_history), 3)  # system prompt + user message + assistant response
-            self.assertEqual(self.chatbot.chat_history[-2]["role"], "user")
-            self.assertEqual(self.chatbot.chat_history[-2]["content"], "Test message")
-            self.assertEqual(self.chatbot.chat_history[-1]["role"], "assistant")
-            self.assertEqual(self.chatbot.chat_history[-1]["content"], "This is a test response")
-
-    def test_chat_stream(self):
-        """测试流式聊天功能"""
-        mock_chunk = Mock()
-        mock_chunk.choices = [Mock(delta=Mock(content="Test "))]
-        mock_chunk2 = Mock()
-        mock_chunk2.choices = [Mock(delta=Mock(content="response"))]
-        
-        mock_stream = [mock_chunk, mock_chunk2]
-        
-        with patch.object(self.chatbot.client.chat.completions, 'create', return_value=mock_stream):
-            response = self.chatbot.chat_stream("Test message", should_print=False)
-            
-            self.assertEqual(response, "Test response")
-            # 验证历史记录是否正确更新
-            self.assertEqual(len(self.chatbot.chat_history), 3)
-            self.assertEqual(self.chatbot.chat_history[-2]["role"], "user")
-            self.assertEqual(self.chatbot.chat_history[-2]["content"], "Test message")
-            self.assertEqual(self.chatbot.chat_history[-1]["role"], "assistant")
-            self.assertEqual(self.chatbot.chat_history[-1]["content"], "Test response")
-
-    def test_error_handling(self):
-        """测试错误处理装饰器"""
-        with patch.object(self.chatbot.client.chat.completions, 'create', side_effect=Exception("API Error")):
-            with self.assertRaises(ConnectionError):
-                self.chatbot.chat("Test message")
-
-    def test_history_persistence(self):
-        """测试聊天历史的持久化"""
-        # 创建一个新的chatbot实例并发送消息
-        mock_response = Mock()
-        mock_response.choices = [
-            Mock(message=Mock(content="Test response"))
-        ]
-        
-        with patch.object(self.chatbot.client.chat.completions, 'create', return_value=mock_response):
-            self.chatbot.chat("Test message", should_print=False)
-        
-        # 创建一个新的实例，验证历史记录是否正确加载
-        chatbot2 = OpenAIChatbot(
-            model_name="gpt-3.5-turbo",
-            history_file=self.history_file,
-            api_key="test_key"
-        )
-        
-        self.assertEqual(len(chatbot2.chat_history), 3)
-        self.assertEqual(chatbot2.chat_history[-2]["content"], "Test message")
-        self.assertEqual(chatbot2.chat_history[-1]["content"], "Test response")
-
-    def test_system_prompt_with_empty_history(self):
-        """测试空历史记录时是否正确添加系统提示"""
-        # 创建一个空的历史文件
-        empty_history_file = Path(self.temp_dir) / "empty_history.json"
-        with open(empty_history_file, 'w', encoding='utf-8') as f:
-            json.dump([], f)  # 写入空数组
-            
-        custom_prompt = "Custom system prompt"
-        chatbot = OpenAIChatbot(
+# Mock()构造和__getattr__都很贵；响应对象用namedtuple，属性访问是C级slot查找
+Msg = namedtuple("Msg", "content")
+Choice = namedtuple("Choice", "message")
+ChatResp = namedtuple("ChatResp", "choices")
+Delta = namedtuple("Delta", "content")
+DeltaChoice = namedtuple("DeltaChoice", "delta")
+StreamChunk = namedtuple("StreamChunk", "choices")
+
+_TEST_RESPONSE = "This is a test response"
+_TEST_MESSAGE = "Test message"
+# 异常实例构造一次重复用；用SUT真正抛出的类型，不走except Exception兜底
+_API_ERR = ConnectionError("API Error")
+
+# 流式chunk只构造一次；tuple迭代比list略快，StubChat每次create给一个新迭代器
+_STREAM_CHUNKS = (StreamChunk([DeltaChoice(Delta("This is a "))]),
+                  StreamChunk([DeltaChoice(Delta("test response"))]))
+
+# 期望的消息dict只构造一次；MappingProxyType防止测试里误改常量
+_SYS = MappingProxyType({"role": "system", "content": "You are a helpful assistant."})
+_USER_MSG = MappingProxyType({"role": "user", "content": _TEST_MESSAGE})
+_ASSISTANT_MSG = MappingProxyType({"role": "assistant", "content": _TEST_RESPONSE})
+
+
+def test_init_missing_history_file(chatbot_cls):
+    """测试历史文件不存在时的错误处理"""
+    with pytest.raises(FileNotFoundError):
+        chatbot_cls(
             model_name="gpt-3.5-turbo",
-            history_file=empty_history_file,
-            system_prompt=custom_prompt,
+            history_file=Path("nonexistent.json"),
             api_key="test_key"
         )
-        
-        # 验证是否正确添加了系统提示
-        self.assertEqual(len(chatbot.chat_history), 1)
-        self.assertEqual(chatbot.chat_history[0]["role"], "system")
-        self.assertEqual(chatbot.chat_history[0]["content"], custom_prompt)
-
-    def test_system_prompt_with_existing_history(self):
-        """测试非空历史记录时是否保持原样"""
-        # 创建一个包含自定义历史记录的文件
-        existing_history_file = Path(self.temp_dir) / "existing_history.json"
-        existing_history = [
-            {"role": "system", "content": "Original system prompt"},
-            {"role": "user", "content": "Hello"},
-            {"role": "assistant", "content": "Hi there"}
-        ]
-        with open(existing_history_file, 'w', encoding='utf-8') as f:
-            json.dump(existing_history, f)
-            
-        # 使用不同的系统提示创建chatbot
-        chatbot = OpenAIChatbot(
+
+
+def test_init_invalid_base_url(chatbot_cls, mock_history_file):
+    """测试非法base_url在构造时就报错"""
+    with pytest.raises(ValueError):
+        chatbot_cls(
             model_name="gpt-3.5-turbo",
-            history_file=existing_history_file,
-            system_prompt="New system prompt",  # 这个不应该被使用
-            api_key="test_key"
+            history_file=mock_history_file,
+            api_key="test_key",
+            base_url="ftp://example.com/v1"
         )
-        
-        # 验证历史记录保持不变
-        self.assertEqual(len(chatbot.chat_history), 3)
-        self.assertEqual(chatbot.chat_history[0]["content"], "Original system prompt")
-        self.assertEqual(chatbot.chat_history[1]["content"], "Hello")
-        self.assertEqual(chatbot.chat_history[2]["content"], "Hi there")
-
-if __name__ == '__main__':
-    unittest.main() 
\ No newline at end of file
+
+
+# 普通/流式聊天只差在create返回的形状和调用的方法名，参数化共用一套fixture
+@pytest.mark.parametrize("method,payload", [
+    ("chat", ChatResp([Choice(Msg(_TEST_RESPONSE))])),
+    ("chat_stream", _STREAM_CHUNKS),
+], ids=["chat", "chat_stream"])
+def test_chat(chatbot, method, payload):
+    """测试普通和流式聊天功能"""
+    chatbot.client.next = payload
+
+    response = getattr(chatbot, method)(_TEST_MESSAGE)
+
+    assert response == _TEST_RESPONSE
+    # 整个历史一次比较完：list.__eq__走C层，失败时pytest的diff也更完整
+    assert chatbot.chat_history == [_SYS, _USER_MSG, _ASSISTANT_MSG]
+
+
+def test_error_handling(chatbot):
+    """测试错误处理装饰器"""
+    chatbot.client.next = _API_ERR
+    with pytest.raises(ConnectionError):
+        chatbot.chat(_TEST_MESSAGE)
+
+
+def test_history_persistence(chatbot_cls, mock_history_file):
+    """测试聊天历史的持久化（真实走磁盘的集成测试）"""
+    chatbot = chatbot_cls(
+        model_name="gpt-3.5-turbo",
+        history_file=mock_history_file,
+        api_key="test_key"
+    )
+    chatbot.client = StubChat()
+    chatbot.client.next = ChatResp([Choice(Msg("Test response"))])
+
+    chatbot.chat(_TEST_MESSAGE)
+
+    # 写入是带缓冲的，先close()落盘再读
+    chatbot.close()
+
+    # 创建一个新的实例，验证历史记录是否正确加载
+    chatbot2 = chatbot_cls(
+        model_name="gpt-3.5-turbo",
+        history_file=mock_history_file,
+        api_key="test_key"
+    )
+
+    assert chatbot2.chat_history == [
+        _SYS, _USER_MSG, {"role": "assistant", "content": "Test response"}]
+
+
+@pytest.mark.skipif(zstandard is None, reason="zstandard not installed")
+def test_zstd_history_roundtrip(chatbot_cls, tmp_path):
+    """测试zstd压缩历史：写入、close落盘、重新加载"""
+    zstd_file = tmp_path / "history.jsonl.zst"
+    zstd_file.write_bytes(b"")
+
+    chatbot = chatbot_cls(
+        model_name="gpt-3.5-turbo",
+        history_file=zstd_file,
+        api_key="test_key"
+    )
+    chatbot.client = StubChat()
+    chatbot.client.next = ChatResp([Choice(Msg("Test response"))])
+    chatbot.chat(_TEST_MESSAGE)
+    chatbot.close()
+
+    chatbot2 = chatbot_cls(
+        model_name="gpt-3.5-turbo",
+        history_file=zstd_file,
+        api_key="test_key"
+    )
+    assert chatbot2.chat_history == [
+        _SYS, _USER_MSG, {"role": "assistant", "content": "Test response"}]
+
+
+def test_empty_message_short_circuit(chatbot):
+    """测试空消息：不应发起API请求，直接返回空串"""
+    assert chatbot.chat("") == ""
+    assert chatbot.chat("   ") == ""
+    assert chatbot.chat_stream("\n") == ""
+    # 历史里不应留下空消息，也不应碰API
+    assert len(chatbot.chat_history) == 1
+    assert chatbot.client.calls == []
+
+
+def test_oversized_message_raises(chatbot_cls, mock_history_file):
+    """测试超出上下文上限的消息：调用前就抛ValueError"""
+    chatbot = chatbot_cls(
+        model_name="gpt-3.5-turbo",
+        history_file=mock_history_file,
+        api_key="test_key",
+        max_context_tokens=10
+    )
+    chatbot.client = StubChat()
+    with pytest.raises(ValueError):
+        chatbot.chat("x" * 1000)
+    assert chatbot.client.calls == []
+
+
+def test_chat_stream_on_token(chatbot):
+    """测试流式回调：每个片段都交给on_token，不走terminal打印"""
+    received = []
+    chatbot.client.next = _STREAM_CHUNKS
+    response = chatbot.chat_stream(_TEST_MESSAGE, on_token=received.append)
+
+    assert response == _TEST_RESPONSE
+    assert received == ["This is a ", "test response"]
+
+
+def test_achat(chatbot, monkeypatch):
+    """测试异步聊天接口"""
+    monkeypatch.setattr(chatbot, "_acreate",
+                        AsyncMock(return_value=ChatResp([Choice(Msg("Async response"))])))
+    response = asyncio.run(chatbot.achat(_TEST_MESSAGE))
+
+    assert response == "Async response"
+    assert chatbot.chat_history[-1]["content"] == "Async response"
+
+
+def test_windowed_messages(chatbot_cls, tmp_path):
+    """测试发送给API的消息窗口：只带system prompt和最近max_turns轮"""
+    windowed_file = tmp_path / "windowed_history.json"
+    long_history = [{"role": "system", "content": "You are a helpful assistant."}]
+    for i in range(30):
+        long_history.append({"role": "user", "content": f"question {i}"})
+        long_history.append({"role": "assistant", "content": f"answer {i}"})
+    dump_json(windowed_file, long_history)
+
+    chatbot = chatbot_cls(
+        model_name="gpt-3.5-turbo",
+        history_file=windowed_file,
+        api_key="test_key",
+        max_turns=2
+    )
+    chatbot.client = StubChat()
+    chatbot.client.next = ChatResp([Choice(Msg("ok"))])
+    chatbot.chat("new question")
+
+    sent = chatbot.client.calls[-1]["messages"]
+    # system prompt + 最近的2*max_turns条消息（含本次用户消息）
+    assert len(sent) == 5
+    assert sent[0]["role"] == "system"
+    assert sent[-1]["content"] == "new question"
+    # 完整历史仍然保留在内存里
+    assert len(chatbot.chat_history) == 63
+
+
+def test_response_cache_hit(chatbot_cls, tmp_path, _history_template):
+    """测试响应缓存：相同请求第二次不应再调用API"""
+    cache_dir = tmp_path / "cache"
+    first_file = tmp_path / "cache_history1.json"
+    second_file = tmp_path / "cache_history2.json"
+    for f in (first_file, second_file):
+        shutil.copy2(_history_template, f)
+
+    # namedtuple上没有tool_calls属性，chat里的getattr(...)拿到None，正常走缓存
+    mock_response = ChatResp([Choice(Msg("Cached response"))])
+
+    chatbot1 = chatbot_cls(
+        model_name="gpt-3.5-turbo",
+        history_file=first_file,
+        api_key="test_key",
+        cache_dir=cache_dir
+    )
+    chatbot1.client = StubChat()
+    chatbot1.client.next = mock_response
+    assert chatbot1.chat(_TEST_MESSAGE) == "Cached response"
+
+    # 同样的请求，第二个实例应该直接命中缓存，不碰API
+    chatbot2 = chatbot_cls(
+        model_name="gpt-3.5-turbo",
+        history_file=second_file,
+        api_key="test_key",
+        cache_dir=cache_dir
+    )
+    chatbot2.client = StubChat()
+    assert chatbot2.chat(_TEST_MESSAGE) == "Cached response"
+    assert chatbot2.client.calls == []
+    assert chatbot2.chat_history[-1]["content"] == "Cached response"
+
+
+_EXISTING_HISTORY = [
+    {"role": "system", "content": "Original system prompt"},
+    {"role": "user", "content": "Hello"},
+    {"role": "assistant", "content": "Hi there"}
+]
+
+
+@pytest.fixture(scope="module", params=[("empty", []), ("existing", _EXISTING_HISTORY)],
+                ids=["empty", "existing"])
+def prebuilt_chatbot(request, chatbot_cls, tmp_path_factory):
+    """空历史/已有历史两种chatbot各构造一次（module scope）。
+
+    测试只读chat_history不改它，所以实例可以跨测试复用，
+    OpenAI client的构造成本只付一遍。
+    """
+    name, initial = request.param
+    history_file = tmp_path_factory.mktemp("prebuilt") / f"{name}_history.json"
+    dump_json(history_file, initial)
+    return name, chatbot_cls(
+        model_name="gpt-3.5-turbo",
+        history_file=history_file,
+        system_prompt="Custom system prompt",  # 只有空历史时才应该被用上
+        api_key="test_key"
+    )
+
+
+def test_system_prompt_initialization(prebuilt_chatbot):
+    """测试system prompt的加载：空历史时注入，非空历史时保持原样"""
+    name, chatbot = prebuilt_chatbot
+    if name == "empty":
+        assert len(chatbot.chat_history) == 1
+        assert chatbot.chat_history[0]["role"] == "system"
+        assert chatbot.chat_history[0]["content"] == "Custom system prompt"
+    else:
+        # 验证历史记录保持不变，构造时传的system_prompt没有被使用
+        assert len(chatbot.chat_history) == 3
+        assert chatbot.chat_history[0]["content"] == "Original system prompt"
+        assert chatbot.chat_history[1]["content"] == "Hello"
+        assert chatbot.chat_history[2]["content"] == "Hi there"